@@ -2,9 +2,12 @@
 
 import os
 import re
+import hashlib
 import sys
 import argparse
 import requests
+from urllib3.util import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # external librairies
 import dotenv
@@ -20,6 +23,32 @@ APPS = {
     "https://quest.fortuna-events.fr": ("$", "#a1e6e6"),
 }
 
+APP_INDEX = {app: index for index, app in enumerate(APPS)}
+
+SEPARATORS = {APPS[app][0]: app for app in APPS}
+
+HEADER = re.compile(r"^([=@?+%$])\1{4}\s*(\w+)")
+
+WORKERS = 16
+
+LZSTRING = lzstring.LZString()
+URL_SAFE = str.maketrans("+/", "-_")
+
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(
+        pool_maxsize=WORKERS,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=["POST", "PATCH"],
+            raise_on_status=False,
+        ),
+    ),
+)
+
 
 class Link:
     def __init__(
@@ -28,36 +57,58 @@ class Link:
         self.app = app
         self.link_name = link_name
         self.data = data
+        self.ascii_data = data.encode("ascii", "xmlcharrefreplace").decode("ascii")
         self.dependencies: list[Link] = []
+        self.dependency_set: set[Link] = set()
+        self.dependency_pattern: re.Pattern | None = None
         self.link = None
+        self.shallow_url = None
         self.resolved = False
         self.preview = preview
+        # links outside of APPS (e.g. DEBUG) fall back to white
+        self.color = f"\033[{31 + APP_INDEX.get(app, len(APPS))};1m"
 
     @property
     def app_name(self) -> str:
         return self.app.split("/")[-1]
 
-    def link_dependencies(self, others: list["Link"]) -> None:
-        for other in others:
-            if other.link_name in self.data:
-                self.dependencies += [other]
+    def link_dependencies(self, others: dict[str, "Link"], pattern: re.Pattern) -> None:
+        for link_name in pattern.findall(self.data):
+            other = others[link_name]
+            if other not in self.dependency_set:
+                self.dependencies.append(other)
+                self.dependency_set.add(other)
+        if len(self.dependencies):
+            names = sorted(
+                (dependency.link_name for dependency in self.dependencies),
+                key=len,
+                reverse=True,
+            )
+            self.dependency_pattern = re.compile("|".join(map(re.escape, names)))
 
     def resolve_shallow(self) -> None:
         if self.link is None:
-            data = self.data.encode("ascii", "xmlcharrefreplace").decode("utf-8")
-            self.link = shorten_url(custom_link(self.app, data))
+            self.shallow_url = custom_link(self.app, self.ascii_data)
+            self.link = shorten_url(self.shallow_url)
+            # without dependencies (a self-reference counts as one) the shallow
+            # link is already the final one
+            self.resolved = not self.dependencies
 
     def resolve(self) -> None:
-        data = self.data.encode("ascii", "xmlcharrefreplace").decode("utf-8")
-        for dependency in self.dependencies:
-            data = data.replace(
-                dependency.link_name,
-                dependency.link,
-            )
+        if self.resolved:
+            return
+        data = self.ascii_data
+        if self.dependency_pattern is not None:
+            links = {
+                dependency.link_name: dependency.link
+                for dependency in self.dependencies
+            }
+            data = self.dependency_pattern.sub(lambda match: links[match[0]], data)
+        url = custom_link(self.app, data)
         if self.link is None:
-            self.link = shorten_url(custom_link(self.app, data), existing=True)
-        else:
-            update_short_url(self.link, custom_link(self.app, data))
+            self.link = shorten_url(url, existing=True)
+        elif url != self.shallow_url:
+            update_short_url(self.link, url)
         self.resolved = True
 
     def status(self) -> str:
@@ -68,9 +119,6 @@ class Link:
         else:
             return f"\033[34;1m{self.link}\033[0m \033[33;1mupdating...\033[0m"
 
-    def color(self) -> str:
-        return f"\033[{31 + list(APPS.keys()).index(self.app)};1m"
-
     def __repr__(self) -> str:
         return self.link_name
 
@@ -80,32 +128,45 @@ class Preview:
         self.links = links
         self.filename = filename
 
-    def compute(self):
-        dot = graphviz.Digraph("preview", format="png", engine="sfdp", strict=True)
-
+    def source(self) -> str:
+        visible = {link for link in self.links if link.preview}
+        lines = ["strict digraph preview {"]
         for link in self.links:
-            if link.preview:
-                dot.node(
-                    link.link_name,
-                    link.link_name,
-                    fillcolor=APPS[link.app][1],
-                    style="filled",
+            if link in visible:
+                lines.append(
+                    f'\t"{link.link_name}" [fillcolor="{APPS[link.app][1]}" style=filled]'
+                )
+                lines.extend(
+                    f'\t"{link.link_name}" -> "{other.link_name}"'
+                    for other in link.dependencies
+                    if other in visible
                 )
-                for other in link.dependencies:
-                    if other.preview:
-                        dot.edge(link.link_name, other.link_name)
+        lines.append("}")
+        return "\n".join(lines)
 
-        dot.render(self.filename)
+    def compute(self):
+        source = self.source()
+        digest = hashlib.blake2b(source.encode(), digest_size=8).hexdigest()
+        if os.path.exists(f"{self.filename}.png"):
+            try:
+                with open(f"{self.filename}.hash", encoding="utf-8") as hash_file:
+                    if hash_file.read() == digest:
+                        print("INFO: preview unchanged, skipping render")
+                        return
+            except OSError:
+                pass
+        graphviz.Source(source, format="png", engine="sfdp").render(self.filename)
+        with open(f"{self.filename}.hash", "w", encoding="utf-8") as hash_file:
+            hash_file.write(digest)
 
 
 def shorten_url(url: str, existing: bool = False) -> str:
-    resp = requests.post(
+    resp = SESSION.post(
         f"{os.environ.get('SHLINK_API_URI')}/short-urls",
-        data={"longUrl": url, "findIfExists": existing},
-        headers={"X-Api-Key": os.environ.get("SHLINK_API_KEY")},
+        json={"longUrl": url, "findIfExists": existing},
     )
 
-    if resp.status_code != 200:
+    if not resp.ok:
         print(f"ERROR: Could not shorten URL: {resp.status_code} {resp.reason}")
         sys.exit(1)
 
@@ -114,13 +175,12 @@ def shorten_url(url: str, existing: bool = False) -> str:
 
 def update_short_url(short_url: str, new_url: str) -> None:
     shortCode = short_url.split("/")[-1]
-    resp = requests.patch(
+    resp = SESSION.patch(
         f"{os.environ.get('SHLINK_API_URI')}/short-urls/{shortCode}",
-        data={"longUrl": new_url},
-        headers={"X-Api-Key": os.environ.get("SHLINK_API_KEY")},
+        json={"longUrl": new_url},
     )
 
-    if resp.status_code != 200:
+    if not resp.ok:
         print(
             f"ERROR: Could not update short URL {short_url}: {resp.status_code} {resp.reason}"
         )
@@ -128,13 +188,7 @@ def update_short_url(short_url: str, new_url: str) -> None:
 
 
 def custom_link(uri: str, data: str) -> str:
-    data = "".join(
-        lzstring.LZString()
-        .compressToBase64(data)
-        .replace("+", "-")
-        .replace("/", "_")
-        .replace("=", "")[::-1]
-    )
+    data = LZSTRING.compressToBase64(data).translate(URL_SAFE).rstrip("=")[::-1]
     return uri + "?z=" + data
 
 
@@ -148,10 +202,9 @@ def __read_data_file(data_path: str) -> list[str]:
 
 
 def __guess_app(separator: str) -> str:
-    for app in APPS:
-        if APPS[app][0] == separator:
-            return app
-    raise Exception(f"Invalid separator: {separator * 5}")
+    if separator not in SEPARATORS:
+        raise Exception(f"Invalid separator: {separator * 5}")
+    return SEPARATORS[separator]
 
 
 def parse_data_file(raw_data: list[str], add_debug: bool) -> list[Link]:
@@ -163,19 +216,21 @@ def parse_data_file(raw_data: list[str], add_debug: bool) -> list[Link]:
     data_buffer = None
     apps: list[Link] = []
     for line in raw_data:
-        match = re.findall(r"^([=@?+%$])\1{4}\s*(\w+)", line)
-        if len(match):
+        match = HEADER.match(line)
+        if match is not None:
             if current_link_name is not None:
-                apps += [Link(current_app, current_link_name, "\n".join(data_buffer))]
-            current_app = __guess_app(match[0][0])
-            current_link_name = match[0][1]
+                apps.append(
+                    Link(current_app, current_link_name, "\n".join(data_buffer))
+                )
+            current_app = __guess_app(match.group(1))
+            current_link_name = match.group(2)
             data_buffer = []
         else:
-            data_buffer += [line]
+            data_buffer.append(line)
     if current_link_name is not None:
-        apps += [Link(current_app, current_link_name, "\n".join(data_buffer))]
+        apps.append(Link(current_app, current_link_name, "\n".join(data_buffer)))
     if add_debug:
-        apps += [
+        apps.append(
             Link(
                 "https://github.com/clement-gouin/z-cross-roads",
                 "DEBUG",
@@ -185,7 +240,7 @@ def parse_data_file(raw_data: list[str], add_debug: bool) -> list[Link]:
                     for app in apps
                 ),
             )
-        ]
+        )
     print(f"INFO: parsed {len(apps)} apps")
     return apps
 
@@ -193,54 +248,128 @@ def parse_data_file(raw_data: list[str], add_debug: bool) -> list[Link]:
 BAR_SIZE = 30
 
 
-def __print_apps(apps: list[Link], clear: bool = True, quiet: bool = False) -> None:
+def __print_apps(
+    apps: list[Link],
+    resolved_count: int,
+    linked_count: int,
+    clear: bool = True,
+    quiet: bool = False,
+) -> None:
+    frame = []
     if clear:
-        if not quiet:
-            for _ in range(len(apps)):
-                print("\x1b[1A\x1b[2K", end="")
-        print("\x1b[1A\x1b[2K", end="")
+        frame.append("\x1b[1A\x1b[2K" * (1 if quiet else len(apps) + 1))
     if not quiet:
         for app in apps:
-            print(f"* {app.color()}{app}\033[0m: {app.status()}")
-    resolved = sum(app.resolved for app in apps) / len(apps)
-    linked = (sum(app.link is not None for app in apps) / len(apps)) - resolved
+            frame.append(f"* {app.color}{app}\033[0m: {app.status()}\n")
+    resolved = resolved_count / len(apps)
+    linked = (linked_count / len(apps)) - resolved
     remaining = 1 - linked - resolved
-    print(
-        f"[\033[32;1m{round(resolved * BAR_SIZE) * '#'}\033[33;1m{round(linked * BAR_SIZE) * '#'}\033[0m{round(remaining * BAR_SIZE) * '·'}] ({linked + resolved:.0%} linked, {resolved:.0%} resolved)"
+    frame.append(
+        f"[\033[32;1m{round(resolved * BAR_SIZE) * '#'}\033[33;1m{round(linked * BAR_SIZE) * '#'}\033[0m{round(remaining * BAR_SIZE) * '·'}] ({linked + resolved:.0%} linked, {resolved:.0%} resolved)\n"
     )
+    sys.stdout.write("".join(frame))
+    sys.stdout.flush()
 
 
 def link_all_apps(apps: list[Link]) -> None:
+    others = {app.link_name: app for app in apps}
+    # longest names first so that a name never shadows another it prefixes
+    pattern = re.compile(
+        "|".join(re.escape(name) for name in sorted(others, key=len, reverse=True))
+    )
     for app in apps:
-        app.link_dependencies(apps)
+        app.link_dependencies(others, pattern)
     print(f"INFO: linked {len(apps)} apps")
 
 
+def __find_cycle(apps: list[Link]) -> list[Link] | None:
+    # 0: unvisited, 1: on the current path, 2: done
+    state = {app: 0 for app in apps}
+    for root in apps:
+        if state[root] != 0:
+            continue
+        state[root] = 1
+        path = [root]
+        stack = [iter(root.dependencies)]
+        while len(stack):
+            dependency = next(stack[-1], None)
+            if dependency is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif state[dependency] == 1:
+                return path[path.index(dependency) :] + [dependency]
+            elif state[dependency] == 0:
+                state[dependency] = 1
+                path.append(dependency)
+                stack.append(iter(dependency.dependencies))
+    return None
+
+
+def __run_all(
+    method,
+    apps: list[Link],
+    all_apps: list[Link],
+    resolved_count: int,
+    linked_count: int,
+    quiet: bool,
+) -> tuple[int, int]:
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        # each app is only changed by its own future, so its state before
+        # submitting tells what the future changed once it completes
+        states = [(app, app.resolved, app.link is not None) for app in apps]
+        futures = {executor.submit(method, state[0]): state for state in states}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except BaseException:
+                # a failed Shlink call exits: do not send the queued calls
+                executor.shutdown(cancel_futures=True)
+                raise
+            app, was_resolved, was_linked = futures[future]
+            resolved_count += app.resolved - was_resolved
+            linked_count += (app.link is not None) - was_linked
+            __print_apps(all_apps, resolved_count, linked_count, quiet=quiet)
+    return resolved_count, linked_count
+
+
 def resolve_all_apps(apps: list[Link], fast: bool = False, quiet: bool = False) -> None:
+    if fast:
+        cycle = __find_cycle(apps)
+        if cycle is not None:
+            print(
+                "ERROR: Cannot resolve fast with cycling dependencies: "
+                + " -> ".join(app.link_name for app in cycle),
+                file=sys.stderr,
+            )
+            sys.exit(1)
     print(f"INFO: resolving links for {len(apps)} apps...")
-    __print_apps(apps, clear=False, quiet=quiet)
+    resolved_count = 0
+    linked_count = 0
+    __print_apps(apps, resolved_count, linked_count, clear=False, quiet=quiet)
     if fast:
-        while any(not app.resolved for app in apps):
-            available = [
-                app
-                for app in apps
-                if not app.resolved and all(dep.resolved for dep in app.dependencies)
-            ]
-            if len(available) == 0:
-                print(
-                    f"ERROR: Cannot resolve fast with cycling dependencies",
-                    file=sys.stderr,
-                )
-                sys.exit(1)
-            available[0].resolve()
-            __print_apps(apps, quiet=quiet)
-    else:
-        for app in apps:
-            app.resolve_shallow()
-            __print_apps(apps, quiet=quiet)
+        pending = {app: len(app.dependencies) for app in apps}
+        dependents: dict[Link, list[Link]] = {app: [] for app in apps}
         for app in apps:
-            app.resolve()
-            __print_apps(apps, quiet=quiet)
+            for dependency in app.dependencies:
+                dependents[dependency].append(app)
+        available = [app for app in apps if pending[app] == 0]
+        while len(available):
+            resolved_count, linked_count = __run_all(
+                Link.resolve, available, apps, resolved_count, linked_count, quiet
+            )
+            ready = []
+            for app in available:
+                for dependent in dependents[app]:
+                    pending[dependent] -= 1
+                    if pending[dependent] == 0:
+                        ready.append(dependent)
+            available = ready
+    else:
+        resolved_count, linked_count = __run_all(
+            Link.resolve_shallow, apps, apps, resolved_count, linked_count, quiet
+        )
+        unresolved = [app for app in apps if not app.resolved]
+        __run_all(Link.resolve, unresolved, apps, resolved_count, linked_count, quiet)
     print(f"INFO: resolved {len(apps)} apps")
 
 
@@ -303,7 +432,9 @@ def __main():
         Preview(apps).compute()
 
     if not args.dry:
-        resolve_all_apps(apps, args.fast)
+        SESSION.headers["X-Api-Key"] = os.environ.get("SHLINK_API_KEY")
+        with SESSION:
+            resolve_all_apps(apps, args.fast)
 
 
 if __name__ == "__main__":